@@ -1,11 +1,11 @@
 import os
-import sys
 import logging
 from flask import Flask
 import atexit
 import json
 from .pbx import definity
-import time
+from .pbx.pool import TerminalPool
+from .pbx.monitor import MonitorRegistry
 
 logging.captureWarnings(True)
 logger = logging.getLogger(__name__)
@@ -16,20 +16,32 @@ logger.info('Loading pbxd config {}'.format(os.environ['PBXD_CONF']))
 with open(os.environ['PBXD_CONF']) as json_file:
     config = json.load(json_file)
 
-pbx = definity.Terminal(
-    config['connection_command'],
-    config['pbx_username'],
-    config['pbx_password'],
-    pbx_command_timeout=os.environ['PBX_COMMAND_TIMEOUT']
-)
+
+def _terminal():
+    return definity.Terminal(
+        config['connection_command'],
+        config['pbx_username'],
+        config['pbx_password'],
+        pbx_command_timeout=os.environ['PBX_COMMAND_TIMEOUT'],
+        trace_bytes=os.environ.get('PBX_TRACE_BYTES', 65536)
+    )
+
+
+# the primary pbx session plus any extra sessions used to run sharded and monitor commands
+pbx = _terminal()
+pool = TerminalPool([pbx] + [_terminal() for i in range(int(os.environ.get('PBX_SESSIONS', 1)) - 1)])
+
+# monitor commands hold a session while they run so one is always kept for other commands
+monitors = MonitorRegistry(pool, max_monitors=len(pool) - 1)
 
 
 # when flask exits disconnect cleanly from the pbx
 @atexit.register
 def pbx_disconnect():
-    if pbx.connected_termtype is not None:
-        logger.info('Logging out of pbx')
-        pbx.disconnect()
+    for terminal in pool.terminals:
+        if terminal.connected_termtype is not None:
+            logger.info('Logging out of pbx')
+            terminal.disconnect()
 
 
 def load():
@@ -42,9 +54,10 @@ def load():
         app.logger.handlers = gunicorn_logger.handlers
         app.logger.setLevel(gunicorn_logger.level)
 
-        definity_logger = logging.getLogger('pbxd.pbx.definity')
-        definity_logger.handlers = gunicorn_logger.handlers
-        definity_logger.setLevel(gunicorn_logger.level)
+        for name in ['pbxd.pbx.definity', 'pbxd.pbx.pool', 'pbxd.pbx.monitor']:
+            pbx_logger = logging.getLogger(name)
+            pbx_logger.handlers = gunicorn_logger.handlers
+            pbx_logger.setLevel(gunicorn_logger.level)
 
     # set the env variable APPLICATION_ROOT to the URL path where the app is served
     app.config["APPLICATION_ROOT"] = os.environ.get("APPLICATION_ROOT", "/")
@@ -53,16 +66,9 @@ def load():
     if app.config["APPLICATION_ROOT"] == "/":
         prefix = ""
 
-    # connect to the PBX when the worker starts
-    try:
-        pbx.connect()
-    except Exception as e:
-        if 'Too many logins' in str(e):
-            logger.error(e)
-            time.sleep(10)
-            sys.exit(1)  # gunicorn respawns the worker
-        else:  # this raises an Exception and stops the container
-            raise Exception('Unable to connect to PBX. {}'.format(e))
+    # connect to the PBX in the background so the worker starts right away,
+    # /ready reports the worker is not ready until a session is logged in
+    pool.connect_in_background(int(os.environ.get('PBX_PREWARM_SESSIONS', 1)))
 
     # register the blueprint routes
     from .main import main
@@ -0,0 +1,260 @@
+"""
+cli.py
+
+Run PBX commands in bulk from the command line without the web service.
+
+The commands are read from a JSONL file, one v3 request object per line:
+
+    {"termtype": "ossi", "command": "display station 12345", "fields": {"8003ff00": ""}}
+
+or from a CSV file with a command column, an optional termtype column (ossi
+is the default) and a column for each OSSI field ID:
+
+    command,8003ff00,8005ff00
+    display station 12345,,
+    change station 12346,New Name,
+
+The commands run on several PBX sessions at the same time and the results
+are written in the order of the input, to a JSONL file with one v3 response
+per command or to a CSV file with one row per field value. With a checkpoint
+file a run that stops can be started again and continues after the last
+command that was written.
+
+Example usage:
+
+    pbxd --config pbxd_conf/pbxd_uw01_conf.json --sessions 3 \\
+        --input stations.csv --output stations.jsonl --checkpoint stations.checkpoint
+
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .pbx import definity
+from .pbx.pool import TerminalPool
+
+logger = logging.getLogger(__name__)
+
+CSV_OUTPUT_COLUMNS = ['line', 'termtype', 'command', 'object', 'field', 'value', 'error']
+
+
+def _file_format(path, file_format):
+    if file_format is not None:
+        return file_format
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+def _csv_requests(f):
+    for line, row in enumerate(csv.DictReader(f), start=1):
+        fields = {k: v for k, v in row.items() if k not in (None, 'termtype', 'command') and v is not None}
+        yield line, {'termtype': row.get('termtype') or 'ossi', 'command': row.get('command'), 'fields': fields}
+
+
+def _jsonl_requests(f):
+    for line, text in enumerate(f, start=1):
+        if text.strip() != '':
+            try:
+                yield line, json.loads(text)
+            except ValueError as e:
+                raise ValueError('Invalid JSON on input line {}: {}'.format(line, e)) from e
+
+
+def read_commands(f, input_format):
+    """
+    Yield the line number and the v3 request object of each input command.
+    """
+    requests = _csv_requests(f) if input_format == 'csv' else _jsonl_requests(f)
+    for line, request in requests:
+        if not isinstance(request, dict) or not request.get('command'):
+            raise ValueError('A command is required on input line {}'.format(line))
+        yield line, dict(request, termtype=request.get('termtype') or 'ossi')
+
+
+class JsonlWriter(object):
+    """
+    Write each response as a JSON object on its own line.
+    """
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, line, request, response):
+        result = {'line': line, 'termtype': request['termtype'], 'command': request['command']}
+        result.update(response)
+        self.f.write(json.dumps(result) + '\n')
+
+
+class CsvWriter(object):
+    """
+    Write each field value, or vt220 screen, of a response as a CSV row.
+    """
+    def __init__(self, f, header=True):
+        self.writer = csv.writer(f)
+        if header:
+            self.writer.writerow(CSV_OUTPUT_COLUMNS)
+
+    def write(self, line, request, response):
+        prefix = [line, request['termtype'], request['command']]
+        error = response.get('error', '')
+        rows = []
+        for i, ossi_object in enumerate(response.get('ossi_objects', [])):
+            rows += [[i + 1, field, value] for field, value in ossi_object.items()]
+        for i, screen in enumerate(response.get('screens', [])):
+            rows.append([i + 1, 'screen', screen])
+        if len(rows) == 0:
+            rows.append(['', '', ''])
+        for row in rows:
+            self.writer.writerow(prefix + row + [error])
+
+
+def read_checkpoint(path):
+    """
+    Return the last input line that was written, 0 when starting a new run,
+    and the size of the output file after it, None when it is not known.
+    """
+    if path is None or not os.path.exists(path):
+        return 0, None
+    with open(path) as f:
+        try:
+            values = [int(value) for value in f.read().split()]
+        except ValueError as e:
+            raise ValueError('Invalid checkpoint file {}'.format(path)) from e
+    line = values[0] if len(values) > 0 else 0
+    offset = values[1] if len(values) > 1 else None
+    return line, offset
+
+
+def write_checkpoint(path, line, offset=None):
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as f:
+        f.write('{}\n'.format(line) if offset is None else '{} {}\n'.format(line, offset))
+    os.replace(tmp_path, path)
+
+
+def run(pool, commands, writer, output, checkpoint=None, done=0):
+    """
+    Run the commands on the pool and write the results in the input order.
+
+    A session that can not log in, for example at the PBX login limit, is
+    skipped and the commands run on the sessions that are logged in. A
+    command that fails with an exception, like a lost connection or no
+    session logged in, stops the run so the checkpoint stays before it. The checkpoint also records
+    the size of a seekable output so output written after the checkpoint
+    can be removed when the run continues.
+    """
+    def finish(line, request, future):
+        writer.write(line, request, future.result())
+        output.flush()
+        if checkpoint is not None:
+            write_checkpoint(checkpoint, line, output.tell() if output.seekable() else None)
+
+    login_failed = threading.Event()
+    count = 0
+    window = 4 * len(pool)  # commands waiting to run or to be written
+    input_error = None
+    commands = iter(commands)
+    with ThreadPoolExecutor(max_workers=len(pool)) as executor:
+        pending = deque()
+        try:
+            while True:
+                try:
+                    line, request = next(commands)
+                except StopIteration:
+                    break
+                except ValueError as e:  # write the commands before the bad input and then stop
+                    input_error = e
+                    break
+                if line <= done:
+                    continue
+                future = executor.submit(pool.send_pbx_command, request['termtype'], request['command'], request.get('fields'),
+                                         login_failed=login_failed)
+                pending.append((line, request, future))
+                while len(pending) >= window:
+                    finish(*pending.popleft())
+                    count += 1
+            while len(pending) > 0:
+                finish(*pending.popleft())
+                count += 1
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+    if input_error is not None:
+        raise input_error
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pbxd', description='Run PBX commands in bulk without the web service.')
+    parser.add_argument('--config', default=os.environ.get('PBXD_CONF'),
+                        help='the pbxd JSON config file (default: $PBXD_CONF)')
+    parser.add_argument('--input', required=True, help='the CSV or JSONL file of commands, - for stdin')
+    parser.add_argument('--input-format', choices=['csv', 'jsonl'], help='default: from the file extension')
+    parser.add_argument('--output', default='-', help='the CSV or JSONL file for the results, - for stdout')
+    parser.add_argument('--output-format', choices=['csv', 'jsonl'], help='default: from the file extension')
+    parser.add_argument('--checkpoint', help='a file that records progress so a run can be started again')
+    parser.add_argument('--sessions', type=int, default=1,
+                        help='the number of PBX logins to use, keep this under the PBX login limit (default: 1)')
+    parser.add_argument('--timeout', type=int, default=int(os.environ.get('PBX_COMMAND_TIMEOUT', 300)),
+                        help='seconds to wait for each PBX command (default: $PBX_COMMAND_TIMEOUT or 300)')
+    parser.add_argument('--log-level', default='WARNING', help='default: WARNING')
+    args = parser.parse_args(argv)
+    if args.config is None:
+        parser.error('--config or PBXD_CONF is required')
+    if args.sessions < 1:
+        parser.error('--sessions must be at least 1')
+
+    logging.basicConfig(stream=sys.stderr, level=args.log_level.upper(),
+                        format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] - %(message)s')
+
+    with open(args.config) as json_file:
+        config = json.load(json_file)
+    pool = TerminalPool([
+        definity.Terminal(
+            config['connection_command'],
+            config['pbx_username'],
+            config['pbx_password'],
+            pbx_command_timeout=args.timeout
+        )
+        for i in range(args.sessions)
+    ])
+
+    input_file = None
+    output_file = None
+    try:
+        done, offset = read_checkpoint(args.checkpoint)
+        if done > 0:
+            logger.warning('Continuing after input line {} from {}'.format(done, args.checkpoint))
+            if args.output != '-' and offset is not None:
+                if not os.path.exists(args.output):
+                    raise ValueError('The output {} of the checkpoint {} is missing'.format(args.output, args.checkpoint))
+                os.truncate(args.output, offset)  # drop output written after the checkpoint
+
+        input_file = sys.stdin if args.input == '-' else open(args.input, newline='')
+        output_file = sys.stdout if args.output == '-' else open(args.output, 'a' if done > 0 else 'w', newline='')
+        commands = read_commands(input_file, _file_format(args.input, args.input_format))
+        if _file_format(args.output, args.output_format) == 'csv':
+            writer = CsvWriter(output_file, header=args.output == '-' or done == 0)
+        else:
+            writer = JsonlWriter(output_file)
+        count = run(pool, commands, writer, output_file, checkpoint=args.checkpoint, done=done)
+        logger.info('{} commands complete'.format(count))
+    except Exception as e:
+        logger.error('Stopped: {}'.format(e))
+        return 1
+    finally:
+        for f in (input_file, output_file):
+            if f not in (None, sys.stdin, sys.stdout):
+                f.close()
+        for terminal in pool.terminals:
+            if terminal.connected_termtype is not None:
+                terminal.disconnect()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
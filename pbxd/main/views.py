@@ -1,5 +1,13 @@
 from . import main
-from ..app import pbx
+from ..app import logger
+from ..app import pool
+from ..pbx.pool import ConnectError
+
+
+@main.errorhandler(ConnectError)
+def pbx_unavailable(e):
+    logger.error(f'Error in health check, unable to connect to PBX: {str(e)}')
+    return {"error": str(e)}, 503
 
 
 @main.route('/ready')
@@ -7,6 +15,8 @@ def readiness():
     """
     Report that a worker is ready to handle a request.
     """
+    if not pool.ready():
+        return 'Not ready, connecting to the PBX', 503
     return 'OK'
 
 
@@ -15,4 +25,18 @@ def liveness():
     """
     Check if the application is able to perform its function.
     """
-    return pbx.ossi_command('display time', fields={"0007ff00": ""}, debug=False)
+    return pool.ossi_command('display time', fields={"0007ff00": ""}, debug=False)
+
+
+@main.route('/trace')
+def trace():
+    """
+    Dump the recent PBX transcript and command timing of each session.
+    """
+    sessions = []
+    for i, terminal in enumerate(pool.terminals):
+        session = terminal.transcript.dump()
+        session['session'] = i
+        session['connected'] = terminal.connected_termtype is not None
+        sessions.append(session)
+    return {'sessions': sessions}
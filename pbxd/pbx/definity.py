@@ -79,7 +79,9 @@ import logging
 import pexpect
 import pyte
 import re
+import time
 from enum import Enum
+from .trace import Transcript
 
 
 class Terminal(object):
@@ -87,7 +89,7 @@ class Terminal(object):
     The pbx terminal object provides a connection to a PBX and methods to run
     commands using the vt220 or ossi terminal types.
     """
-    def __init__(self, connection_command, pbx_username, pbx_password, pbx_command_timeout=300):
+    def __init__(self, connection_command, pbx_username, pbx_password, pbx_command_timeout=300, trace_bytes=65536):
         self.logger = logging.getLogger(__name__)
         self.connection_command = connection_command
         self.pbx_username = pbx_username
@@ -95,6 +97,7 @@ class Terminal(object):
         self.session = None
         self.connected_termtype = None
         self.pbx_command_timeout = int(pbx_command_timeout)
+        self.transcript = Transcript(max_bytes=int(trace_bytes))
 
     class Termtype(Enum):
         """
@@ -109,6 +112,7 @@ class Terminal(object):
         """
         self.logger.info('Connecting to pbx: {}'.format(self.connection_command))
         self.session = pexpect.spawn(self.connection_command, timeout=5)
+        self.session.logfile_read = self.transcript.reader
 
         # Password
         index = self.session.expect(
@@ -129,6 +133,7 @@ class Terminal(object):
         elif index == 2:  # Password
             self.logger.debug('Sending pbx_password')
             self.session.sendline(self.pbx_password)
+            self.session.logfile_send = self.transcript.sender  # record what is sent after the password
 
         self._select_termtype(self.Termtype.ossi)
 
@@ -241,7 +246,15 @@ class Terminal(object):
             self.logger.error('duplicate field ids detected {} != {}'.format(response_fields, ossi_obj.keys()))
         return ossi_obj
 
-    def ossi_command(self, command, fields=None, debug=False):
+    def _ossi_response(self, response_fields, rows, columnar=False):
+        """
+        Convert the OSSI rows to a list of dictionaries or to columnar lists.
+        """
+        if columnar:
+            return {"ossi_fields": response_fields, "ossi_rows": rows}
+        return {"ossi_objects": [self._ossi_object(response_fields, row) for row in rows]}
+
+    def ossi_command(self, command, fields=None, debug=False, columnar=False):
         """
         Send a command to the PBX and return the result.
 
@@ -254,6 +267,10 @@ class Terminal(object):
         Note: there have been cases of duplicate field ids from the PBX so the
         data_list is available without ids if needed.
 
+        With columnar=True the field ids are returned once in ossi_fields and
+        each object is a list of values in ossi_rows. This is smaller than a
+        dictionary per object and keeps duplicate field ids.
+
         The OSSI lines:
         The first character in each OSSI line identifies its content.
         c: the command being run
@@ -264,6 +281,8 @@ class Terminal(object):
         n: a line with a single n identifies the start of a new item in a list
         t: a line with a single t identifies end of the ossi command output
         """
+        start = time.monotonic()
+
         # switch back to the original ossi OSSI terminal type
         self._select_termtype(self.Termtype.ossi)
 
@@ -273,12 +292,11 @@ class Terminal(object):
 
         # if no fields are specificed the pbx returns all fields
         if fields is not None and len(fields) > 0:
-            self.logger.debug('fields: {}'.format(fields))
             ids = ('\t'.join(sorted(fields))).strip()
             data = ('\t'.join([fields[k] for k in sorted(fields)]))
-            self.logger.debug('send: f{}'.format(ids))
+            self.logger.debug('send: f%s', ids)
             self.session.sendline('f{}'.format(ids))  # fields
-            self.logger.debug('send: d{}'.format(data))
+            self.logger.debug('send: d%s', data)
             self.session.sendline('d{}'.format(data))  # data
 
         self.session.sendline('t')  # command terminator
@@ -288,7 +306,7 @@ class Terminal(object):
         response_data = []
         response_errors = []
         complete_output = False
-        ossi_objects = []
+        rows = []
         raw_lines = []
         while not complete_output:
             index = self.session.expect(
@@ -313,16 +331,15 @@ class Terminal(object):
                 self.logger.error('{}: {}\n{}'.format(response_errors, command, self.session.before))
                 complete_output = True
             if index >= 2:
-                self.logger.debug('after: {}'.format(self.session.after))
                 raw_line = self.session.after.decode('utf-8')
                 raw_lines.append(raw_line)
                 if index == 2:  # match a line of field ids
                     field_ids = raw_line[1:].rstrip('\r\n').split('\t')
-                    self.logger.debug('f {} {}'.format(len(field_ids), field_ids))
+                    self.logger.debug('f %d %s', len(field_ids), field_ids)
                     response_fields += field_ids
                 elif index == 3:  # match a line of data values
                     field_values = raw_line[1:].rstrip('\r\n').split('\t')
-                    self.logger.debug('d {} {}'.format(len(field_values), field_values))
+                    self.logger.debug('d %d %s', len(field_values), field_values)
                     response_data += field_values
                 elif index == 4:  # match an error line
                     error_values = raw_line[1:].rstrip('\r\n').split(' ', 3)
@@ -334,29 +351,30 @@ class Terminal(object):
                     if len(response_data) > 0:
                         if len(response_fields) != len(response_data):
                             self.logger.error("corrupt object: {} fields, {} values".format(len(response_fields), len(response_data)))  # noqa E501
-                        ossi_objects.append(self._ossi_object(response_fields, response_data))
+                        rows.append(response_data)
                         response_data = []
                 elif index == 6:  # t = command output is complete
                     self.logger.info("command output complete")
                     if len(response_data) > 0:
                         if len(response_fields) != len(response_data):
                             self.logger.error("corrupt object: {} fields, {} values".format(len(response_fields), len(response_data)))  # noqa E501
-                        ossi_objects.append(self._ossi_object(response_fields, response_data))
+                        rows.append(response_data)
                         response_data = []
                     complete_output = True
 
-        response_obj = {"ossi_objects": ossi_objects}
+        response_obj = self._ossi_response(response_fields, rows, columnar)
         if len(response_errors) > 0:
             response_obj['error'] = "\n".join(response_errors)
         if debug is not False:
             response_obj['debug'] = raw_lines
-        self.logger.debug(response_obj)
+        self.transcript.span(command, 'ossi', start, objects=len(rows), error=response_obj.get('error'))
         return response_obj
 
     def vt220_command(self, command):
         """
         Run a command in the vt220 terminal and return the PBX screens.
         """
+        start = time.monotonic()
         self._select_termtype(self.Termtype.vt220)
         screens = []
         response_error = None
@@ -385,7 +403,7 @@ class Terminal(object):
                 response_error = 'PBX connection failed with EOF'
                 self.logger.error('{}: {}\n{}'.format(response_error, command, self.session.before))
             elif index >= 2:
-                self.logger.debug('{} saving screen:\n{}'.format(index, self.session.after))
+                self.logger.debug('%d saving screen:\n%s', index, self.session.after)
                 screen = pyte.Screen(80, 24)
                 stream = pyte.Stream(screen)
                 stream.feed(self.session.before.decode('utf-8'))
@@ -405,7 +423,7 @@ class Terminal(object):
                 else:  # look for paging
                     m = re.match(r'.*Page +(\d+) of +(\d+).*', self.session.before.decode('utf-8'))
                     if m is not None and m.group(1) < m.group(2):
-                        self.logger.debug('page {} of {}: requesting next page'.format(m.group(1), m.group(2)))
+                        self.logger.debug('page %s of %s: requesting next page', m.group(1), m.group(2))
                         more_pages = True
                         self.session.send(b'\x1b[6~')  # VT220 next page
 
@@ -430,9 +448,75 @@ class Terminal(object):
         response_obj = {"screens": screens}
         if response_error is not None:
             response_obj['error'] = response_error
+        self.transcript.span(command, 'vt220', start, screens=len(screens), error=response_error)
         return response_obj
 
-    def send_pbx_command(self, termtype, command, fields, debug=False):
+    def vt220_monitor(self, command, publish, stopped):
+        """
+        Run a monitor command in the vt220 terminal until stopped() is true.
+
+        The PBX redraws the monitor screen until the command is cancelled.
+        publish is called with the list of screen lines after each redraw.
+        Returns an error message or None.
+        """
+        self._select_termtype(self.Termtype.vt220)
+        screen = pyte.Screen(80, 24)
+        stream = pyte.Stream(screen)
+        response_error = None
+
+        self.logger.info('monitor: {}'.format(command))
+        self.session.sendline(command)
+        last_page = time.monotonic()
+        while not stopped():
+            index = self.session.expect(
+                [
+                    pexpect.TIMEOUT,
+                    pexpect.EOF,
+                    r'\x1b\[23;80H',  # end of monitor page
+                    r'\[KCommand: ',  # the command ended
+                ],
+                timeout=1  # check stopped() every second
+            )
+            if index == 0:  # TIMEOUT
+                if time.monotonic() - last_page > self.pbx_command_timeout:
+                    response_error = 'PBX timeout'
+                    self.logger.error('{}: {}\n{}'.format(response_error, command, self.session.before))
+                    break
+            elif index == 1:  # EOF
+                response_error = 'PBX connection failed with EOF'
+                self.logger.error('{}: {}\n{}'.format(response_error, command, self.session.before))
+                return response_error
+            else:
+                last_page = time.monotonic()
+                stream.feed((self.session.before + self.session.after).decode('utf-8'))
+                publish(list(screen.display))
+                if index == 3:  # check for an error message at the command prompt
+                    pbx_message = screen.display[22].strip()
+                    if pbx_message != '' and pbx_message != 'Command successfully completed':
+                        response_error = pbx_message  # error is on line 23
+                        self.logger.warning(response_error)
+                    return response_error
+
+        self.logger.info('monitor stopped')
+
+        # return to the vt220 prompt and consume it
+        self.session.send(b'\x1b[3~')  # VT220 cancel
+        index = self.session.expect(
+            [
+                pexpect.TIMEOUT,
+                pexpect.EOF,
+                r'\[KCommand:',
+            ]
+        )
+        if index == 0:  # TIMEOUT
+            response_error = 'Timeout on vt220_monitor'
+            self.logger.error('{}: {}\n{}'.format(response_error, command, self.session.before))
+        elif index == 1:  # EOF
+            response_error = 'Connection failed with EOF on vt220_monitor'
+            self.logger.error('{}: {}\n{}'.format(response_error, command, self.session.before))
+        return response_error
+
+    def send_pbx_command(self, termtype, command, fields, debug=False, columnar=False):
         """
         run a command with the requested termtype
         """
@@ -440,6 +524,6 @@ class Terminal(object):
         if termtype == self.Termtype.vt220.name:
             return self.vt220_command(command)
         elif termtype == self.Termtype.ossi.name:
-            return self.ossi_command(command, fields=fields, debug=debug)
+            return self.ossi_command(command, fields=fields, debug=debug, columnar=columnar)
         else:
             return {"error": "Unknown termtype. Must be ossi or vt220."}
@@ -0,0 +1,197 @@
+"""
+monitor.py
+
+Share the screens of long running vt220 monitor commands between clients.
+
+A command like "monitor traffic trunk-groups" keeps redrawing its screen
+until it is cancelled. The first client that subscribes to a command starts
+it on a session from the TerminalPool and every later client subscribed to
+the same command gets the same screens. The command is cancelled and the
+session is returned to the pool when the last client unsubscribes.
+
+Example usage:
+
+    monitors = MonitorRegistry(pool, max_monitors=1)
+    subscription = monitors.subscribe('monitor traffic trunk-groups')
+    try:
+        while True:
+            event = subscription.get()
+            if event is None:  # the monitor command has ended
+                break
+            print('\\n'.join(event['screen']))
+    finally:
+        monitors.unsubscribe(subscription)
+
+"""
+
+import logging
+import queue
+import threading
+
+SUBSCRIBER_QUEUE_SIZE = 10  # screens waiting for a slow client
+
+
+class MonitorBusy(Exception):
+    """
+    There is no session free to start another monitor command.
+    """
+
+
+class Subscription(object):
+    """
+    A client's queue of screen events from a monitor command.
+
+    Each event is a dictionary with the screen lines and the changed lines
+    since the previous event or an error message. A None event marks the end
+    of the monitor command.
+    """
+    def __init__(self, monitor):
+        self.monitor = monitor
+        self._events = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put(self, event):
+        try:
+            self._events.put_nowait(event)
+        except queue.Full:
+            # a slow client skips to the current screen
+            try:
+                while True:
+                    self._events.get_nowait()
+            except queue.Empty:  # the client may take the last event at the same time
+                pass
+            if event is not None and event.get('screen') is not None:
+                event = dict(event, changed=None)
+            self._events.put_nowait(event)
+
+    def get(self, timeout=None):
+        """
+        Wait for the next event. Raises queue.Empty after timeout seconds.
+        """
+        return self._events.get(timeout=timeout)
+
+
+class Monitor(object):
+    """
+    One monitor command running on a pool session for all of its subscribers.
+    """
+    def __init__(self, pool, command, on_finished):
+        self.logger = logging.getLogger(__name__)
+        self.pool = pool
+        self.command = command
+        self.subscriptions = set()
+        self.screen = None
+        self._on_finished = on_finished
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='monitor: {}'.format(command), daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def add(self, subscription):
+        with self._lock:
+            self.subscriptions.add(subscription)
+            if self.screen is not None:  # new subscribers start with the current screen
+                subscription.put({'screen': self.screen, 'changed': None})
+
+    def remove(self, subscription):
+        with self._lock:
+            self.subscriptions.discard(subscription)
+            return len(self.subscriptions)
+
+    def _publish(self, event):
+        with self._lock:
+            for subscription in self.subscriptions:
+                subscription.put(event)
+
+    def _publish_screen(self, lines):
+        changed = None
+        if self.screen is not None:
+            changed = {i: line for i, line in enumerate(lines) if line != self.screen[i]}
+            if len(changed) == 0:
+                return
+        self.screen = lines
+        self._publish({'screen': lines, 'changed': changed})
+
+    def _reset(self, terminal):
+        """
+        Log the terminal in again after a failed monitor command.
+
+        The PBX may still be running the monitor, so the session is not
+        returned to the pool as it is.
+        """
+        try:
+            terminal.reconnect()
+        except Exception as e:
+            self.logger.error('unable to reconnect after monitor {}: {}'.format(self.command, e))
+            if terminal.session is not None:
+                terminal.session.close()
+            terminal.session = None  # the pool logs in again when the session is next used
+            terminal.connected_termtype = None
+
+    def _run(self):
+        error = None
+        try:
+            with self.pool.terminal() as terminal:
+                if not self._stop.is_set():
+                    try:
+                        error = terminal.vt220_monitor(self.command, self._publish_screen, self._stop.is_set)
+                    except Exception:
+                        self._reset(terminal)
+                        raise
+        except Exception as e:
+            self.logger.error('monitor {} failed: {}'.format(self.command, e))
+            error = str(e)
+        self._on_finished(self)
+        if error is not None:
+            self._publish({'error': error})
+        self._publish(None)
+
+
+class MonitorRegistry(object):
+    """
+    The monitor commands that are running and their subscribers.
+
+    max_monitors limits the pool sessions used by monitor commands so the
+    other sessions are left for normal commands.
+    """
+    def __init__(self, pool, max_monitors):
+        self.pool = pool
+        self.max_monitors = max_monitors
+        self.monitors = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, command):
+        """
+        Subscribe to a monitor command and start it if it is not running.
+        """
+        with self._lock:
+            monitor = self.monitors.get(command)
+            if monitor is None:
+                if len(self.monitors) >= self.max_monitors:
+                    raise MonitorBusy('All {} monitor sessions are in use'.format(self.max_monitors))
+                monitor = Monitor(self.pool, command, self._finished)
+                self.monitors[command] = monitor
+                monitor.start()
+            subscription = Subscription(monitor)
+            monitor.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Unsubscribe from a monitor command and stop it if nobody is watching.
+        """
+        monitor = subscription.monitor
+        with self._lock:
+            if monitor.remove(subscription) == 0:
+                if self.monitors.get(monitor.command) is monitor:
+                    del self.monitors[monitor.command]
+                monitor.stop()
+
+    def _finished(self, monitor):
+        with self._lock:
+            if self.monitors.get(monitor.command) is monitor:
+                del self.monitors[monitor.command]
@@ -0,0 +1,272 @@
+"""
+pool.py
+
+A pool of PBX terminal sessions.
+
+A single SAT login runs one command at a time. The pool holds several
+definity.Terminal sessions so that independent pieces of work, like the
+shards of a large list command or a long running monitor command, can run on
+the PBX at the same time. Each session is only used by one thread at a time.
+
+Example usage:
+
+    import pbxd.pbx.definity as definity
+    from pbxd.pbx.pool import TerminalPool
+
+    pool = TerminalPool([
+        definity.Terminal(connection_command, pbx_username, pbx_password)
+        for i in range(3)
+    ])
+
+    # list the stations in three ranges at the same time
+    result = pool.ossi_command_sharded(
+        'list station',
+        ['10000 to-ext 19999', '20000 to-ext 29999', '30000 to-ext 39999'],
+        fields={'8005ff00': ''}
+    )
+
+"""
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+CONNECT_BACKOFF_INITIAL = 1  # seconds before the first login retry
+CONNECT_BACKOFF_MAX = 60  # longest wait between login retries
+
+
+class ConnectError(Exception):
+    """
+    A pool session could not log in to the PBX.
+    """
+
+
+def merge_ossi_responses(responses):
+    """
+    Merge a list of ossi_command responses into a single response.
+
+    The ossi_objects, or the ossi_rows of columnar responses, are kept in the
+    order of the responses so merging the shards of a command gives the same
+    result as the unsharded command.
+    """
+    columnar = any('ossi_rows' in response for response in responses)
+    ossi_fields = []
+    ossi_objects = []
+    errors = []
+    raw_lines = None
+    for response in responses:
+        if columnar:
+            if len(ossi_fields) == 0:
+                ossi_fields = response.get('ossi_fields', [])
+            ossi_objects += response.get('ossi_rows', [])
+        else:
+            ossi_objects += response.get('ossi_objects', [])
+        if response.get('error') is not None:
+            errors.append(response['error'])
+        if response.get('debug') is not None:
+            raw_lines = (raw_lines or []) + response['debug']
+
+    if columnar:
+        response_obj = {"ossi_fields": ossi_fields, "ossi_rows": ossi_objects}
+    else:
+        response_obj = {"ossi_objects": ossi_objects}
+    if len(errors) > 0:
+        response_obj['error'] = "\n".join(errors)
+    if raw_lines is not None:
+        response_obj['debug'] = raw_lines
+    return response_obj
+
+
+class TerminalPool(object):
+    """
+    A fixed set of Terminal sessions that can run commands concurrently.
+
+    The first terminal is the primary session and is handed out first.
+    Connected sessions are handed out before sessions that are not connected
+    yet, and those are connected when they are acquired. While a background
+    login is retrying only connected sessions are handed out, so requests do
+    not add logins of their own while the PBX is refusing them.
+    """
+    def __init__(self, terminals):
+        self.logger = logging.getLogger(__name__)
+        self.terminals = list(terminals)
+        self._idle = list(reversed(self.terminals))  # the end of the list is handed out first
+        self._available = threading.Condition()
+        self._retrying = set()  # terminals with a failed background login
+
+    def __len__(self):
+        return len(self.terminals)
+
+    def ready(self):
+        """
+        Report if any session is logged in to the PBX.
+        """
+        return any(terminal.connected_termtype is not None for terminal in self.terminals)
+
+    def _take(self, timeout=None, terminal=None, connected=False):
+        """
+        Remove an idle terminal, or the requested terminal, from the idle list.
+
+        With connected=True only a session that is already logged in is
+        taken, and ConnectError is raised when no session is logged in.
+        """
+        def available():
+            if terminal is not None:
+                return terminal in self._idle
+            if connected:
+                return any(t.session is not None for t in self._idle) or all(t.session is None for t in self.terminals)
+            return len(self._idle) > 0
+
+        with self._available:
+            if not self._available.wait_for(available, timeout):
+                raise queue.Empty('No idle PBX session')
+            if terminal is None:
+                idle_connected = [t for t in self._idle if t.session is not None]
+                if connected and len(idle_connected) == 0:
+                    raise ConnectError('Unable to connect to PBX, no session is logged in')
+                terminal = idle_connected[-1] if len(idle_connected) > 0 else self._idle[-1]
+            self._idle.remove(terminal)
+            return terminal
+
+    def _give(self, terminal):
+        with self._available:
+            self._idle.append(terminal)
+            self._available.notify_all()
+
+    def _connect(self, terminal):
+        """
+        Log in to the PBX and clean up the session if the login fails.
+        """
+        try:
+            terminal.connect()
+        except Exception:
+            if terminal.session is not None:
+                terminal.session.close()
+            terminal.session = None
+            terminal.connected_termtype = None
+            raise
+
+    @contextmanager
+    def terminal(self, timeout=None, connected=False):
+        """
+        Borrow an idle terminal for the duration of a with block.
+
+        Raises ConnectError if the terminal can not log in to the PBX.
+        """
+        if len(self._retrying) > 0:
+            connected = True
+        terminal = self._take(timeout=timeout, connected=connected)
+        try:
+            if terminal.session is None:
+                try:
+                    self._connect(terminal)
+                except Exception as e:
+                    raise ConnectError('Unable to connect to PBX. {}'.format(e)) from e
+            yield terminal
+        finally:
+            self._give(terminal)
+
+    def _warm(self, terminal):
+        """
+        Log in a session, retrying with exponential backoff until it succeeds.
+        """
+        delay = CONNECT_BACKOFF_INITIAL
+        while True:
+            self._take(terminal=terminal)
+            try:
+                if terminal.session is None:
+                    self._connect(terminal)
+                self._retrying.discard(terminal)
+                return
+            except Exception as e:
+                self._retrying.add(terminal)
+                self.logger.error('Unable to connect to PBX, retrying in {} seconds. {}'.format(delay, e))
+            finally:
+                self._give(terminal)
+            time.sleep(delay)
+            delay = min(delay * 2, CONNECT_BACKOFF_MAX)
+
+    def connect_in_background(self, sessions=1):
+        """
+        Start logging in the first sessions without waiting for the PBX.
+
+        Each session is available as soon as its login succeeds. The other
+        sessions are connected when they are first needed.
+        """
+        for terminal in self.terminals[:sessions]:
+            threading.Thread(target=self._warm, args=(terminal,), name='pbx connect', daemon=True).start()
+
+    def _run_on_terminal(self, run, login_failed):
+        """
+        Call run(terminal) on an idle terminal and return its result.
+
+        When a terminal can not log in, login_failed is set and run is called
+        on a terminal that is logged in instead. Once login_failed is set no
+        more logins are tried. Raises ConnectError if no terminal is logged in.
+        """
+        if not login_failed.is_set():
+            try:
+                with self.terminal() as terminal:
+                    return run(terminal)
+            except ConnectError as e:
+                self.logger.error('{}, running the command on a connected session'.format(e))
+                login_failed.set()
+        with self.terminal(connected=True) as terminal:
+            return run(terminal)
+
+    def ossi_command(self, command, fields=None, debug=False, columnar=False):
+        """
+        Run Terminal.ossi_command on an idle terminal.
+        """
+        with self.terminal() as terminal:
+            return terminal.ossi_command(command, fields=fields, debug=debug, columnar=columnar)
+
+    def send_pbx_command(self, termtype, command, fields, debug=False, columnar=False, login_failed=None):
+        """
+        Run Terminal.send_pbx_command on an idle terminal.
+
+        With a login_failed threading.Event that is shared by several commands
+        a terminal that can not log in is skipped and the commands run on the
+        terminals that are logged in.
+        """
+        def run(terminal):
+            return terminal.send_pbx_command(termtype, command, fields, debug=debug, columnar=columnar)
+
+        if login_failed is not None:
+            return self._run_on_terminal(run, login_failed)
+        with self.terminal() as terminal:
+            return run(terminal)
+
+    def ossi_command_sharded(self, command, shards, fields=None, debug=False, columnar=False):
+        """
+        Run an OSSI list command once for each shard and merge the results.
+
+        Each shard is appended to the command to select a range of the list,
+        for example '10000 to-ext 19999'. The shards run concurrently on as
+        many sessions as the pool has and the ossi_objects are merged in the
+        order of the shards.
+
+        When a session can not log in its shards run on the sessions that
+        are logged in, so the command runs on fewer sessions instead of
+        failing.
+        """
+        login_failed = threading.Event()
+
+        def run_shard(shard):
+            def run(terminal):
+                return terminal.ossi_command('{} {}'.format(command, shard), fields=fields, debug=debug, columnar=columnar)
+
+            try:
+                return self._run_on_terminal(run, login_failed)
+            except ConnectError as e:
+                response = {'ossi_fields': [], 'ossi_rows': []} if columnar else {'ossi_objects': []}
+                response['error'] = str(e)
+                return response
+
+        self.logger.info('command: {} in {} shards'.format(command, len(shards)))
+        with ThreadPoolExecutor(max_workers=max(1, min(len(self.terminals), len(shards)))) as executor:
+            responses = list(executor.map(run_shard, shards))
+        return merge_ossi_responses(responses)
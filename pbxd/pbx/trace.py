@@ -0,0 +1,84 @@
+"""
+trace.py
+
+Cheap, always on tracing of a PBX session.
+
+The Transcript keeps the most recent bytes sent to and read from the PBX and
+the timing of the most recent commands in bounded memory. It can be dumped
+when a problem like an unexpected field ID or a timeout needs to be
+diagnosed, without running the whole service with DEBUG logging.
+
+The reader and sender attributes are file like objects for the pexpect
+logfile_read and logfile_send hooks.
+"""
+
+import threading
+import time
+from collections import deque
+
+
+class _TranscriptFile(object):
+    """
+    A file like object that records everything written to it in a Transcript.
+    """
+    def __init__(self, transcript, direction):
+        self.transcript = transcript
+        self.direction = direction
+
+    def write(self, data):
+        self.transcript.record(self.direction, data)
+
+    def flush(self):
+        pass
+
+
+class Transcript(object):
+    """
+    A ring buffer of raw PBX bytes and command timing spans.
+    """
+    def __init__(self, max_bytes=65536, max_spans=100):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.chunks = deque()
+        self.spans = deque(maxlen=max_spans)
+        self.reader = _TranscriptFile(self, 'read')
+        self.sender = _TranscriptFile(self, 'send')
+        self._lock = threading.Lock()
+
+    def record(self, direction, data):
+        """
+        Add bytes to the transcript and drop the oldest bytes over max_bytes.
+        """
+        with self._lock:
+            self.chunks.append((time.time(), direction, data))
+            self.size += len(data)
+            while self.size > self.max_bytes and len(self.chunks) > 1:
+                self.size -= len(self.chunks.popleft()[2])
+
+    def span(self, command, termtype, start, **details):
+        """
+        Record the timing of a command that started at time.monotonic() start.
+        """
+        span = {
+            'command': command,
+            'termtype': termtype,
+            'time': time.time() - (time.monotonic() - start),
+            'seconds': round(time.monotonic() - start, 6),
+        }
+        span.update(details)
+        with self._lock:
+            self.spans.append(span)
+
+    def dump(self):
+        """
+        Return the transcript as a JSON serializable dictionary.
+        """
+        with self._lock:
+            chunks = list(self.chunks)
+            spans = list(self.spans)
+        transcript = []
+        for t, direction, data in chunks:
+            if isinstance(data, bytes):
+                data = data.decode('utf-8', errors='replace')
+            transcript.append({'time': t, 'direction': direction, 'data': data})
+        return {'spans': spans, 'transcript': transcript}
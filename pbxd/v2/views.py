@@ -2,44 +2,76 @@ from . import v2
 from flask import request, abort
 from ..app import logger
 import xmltodict
-from collections import OrderedDict
-from ..app import pbx
+from xml.sax.saxutils import escape, quoteattr
+from ..app import pool
+from ..pbx.pool import ConnectError
 from flask import current_app as app
 
+XML_CHUNK_SIZE = 65536  # characters of xml sent to the client at a time
 
-def _convert_v3_response_to_v2(pbx_name, termtype, command, v3_response):
+
+def _ossi_object_xml(i, ossi_fields, row):
+    """
+    Write one <ossi_object> element from a row of OSSI values.
+    """
+    if len(set(ossi_fields)) != len(ossi_fields):
+        # duplicate field ids keep the first position and the last value like a dict
+        values = {}
+        for field, value in zip(ossi_fields, row):
+            values[field] = value
+        fields = values.items()
+    else:
+        fields = zip(ossi_fields, row)
+    lines = ['  <ossi_object i="{}">\n'.format(i)]
+    for field, value in fields:
+        lines.append('    <field fid={}>{}</field>\n'.format(quoteattr(field), escape(value)))
+    lines.append('  </ossi_object>\n')
+    return ''.join(lines)
+
+
+def _v2_xml(pbx_name, termtype, command, v3_response):
     """
-    Convert the v3 response to the legacy v2 xml format.
+    Write the v3 response in the legacy v2 xml format one element at a time.
+
+    The output is the same as xmltodict.unparse(pretty=True, indent='  ')
+    without building the whole document in memory.
     """
-    logger.debug(v3_response)
-    obj = {
-        'command': {'@cmd': command, '@cmdType': termtype, '@pbxName': pbx_name}
-    }
+    yield '<?xml version="1.0" encoding="utf-8"?>\n<command cmd={} cmdType={} pbxName={}>'.format(
+        quoteattr(command), quoteattr(termtype), quoteattr(pbx_name))
+
     if v3_response.get('error') is not None:
-        obj['command']['error'] = 'ERROR: {}'.format(v3_response['error'])
+        yield '\n  <error>{}</error>\n'.format(escape('ERROR: {}'.format(v3_response['error'])))
 
     elif v3_response.get('screens') is not None:
-        screens = []
+        yield '\n'
         for i, screen in enumerate(v3_response['screens']):
-            screens.append(OrderedDict([('@page', i + 1), ('#text', screen)]))
-        obj['command']['screen'] = screens
+            yield '  <screen page="{}">{}</screen>\n'.format(i + 1, escape(screen))
+
+    elif v3_response.get('ossi_rows') is not None:
+        yield '\n'
+        if len(v3_response['ossi_rows']) == 0:
+            yield '  <ossi_object></ossi_object>\n'
+        for i, row in enumerate(v3_response['ossi_rows']):
+            yield _ossi_object_xml(i + 1, v3_response['ossi_fields'], row)
 
-    elif v3_response.get('ossi_objects') is not None:
-        ossi_objects = []
-        for i, o in enumerate(v3_response['ossi_objects']):
-            fields = []
-            for field in o:
-                fields.append(OrderedDict([('@fid', field), ('#text', o[field])]))
-            od = OrderedDict([('@i', i + 1), ('field', fields)])
-            ossi_objects.append(od)
-        if len(ossi_objects) == 0:
-            ossi_objects = {}
-        obj['command']['ossi_object'] = ossi_objects
+    yield '</command>'
 
-    logger.debug(obj)
 
-    xml = xmltodict.unparse(obj, pretty=True, indent='  ')
-    return xml
+def _chunks(pieces, size=XML_CHUNK_SIZE):
+    """
+    Join small pieces of text into chunks of about size characters.
+    """
+    chunk = []
+    length = 0
+    for piece in pieces:
+        chunk.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    if len(chunk) > 0:
+        yield ''.join(chunk)
 
 
 @v2.route("/", methods=["POST"])
@@ -71,8 +103,12 @@ def legacy_xml_post():
     except Exception:
         abort(400, description="Bad request")
 
-    v3_response = pbx.send_pbx_command(termtype, command, fields, debug=False)
-    xml = _convert_v3_response_to_v2(pbx_name, termtype, command, v3_response)
-    resp = app.make_response(xml)
-    resp.mimetype = "text/xml"
-    return resp
+    status = 200
+    try:
+        v3_response = pool.send_pbx_command(termtype, command, fields, debug=False, columnar=True)
+    except ConnectError as e:
+        logger.error(f'Error in v2, unable to connect to PBX: {str(e)}')
+        v3_response = {"error": str(e)}
+        status = 503
+    xml = _chunks(_v2_xml(pbx_name, termtype, command, v3_response))
+    return app.response_class(xml, status=status, mimetype="text/xml")
@@ -0,0 +1,101 @@
+"""
+Content negotiation for v3 responses.
+
+The response body is JSON unless the client asks for MessagePack or CBOR in
+the Accept header, and it is compressed with gzip or zstd when the client
+allows it in the Accept-Encoding header. Streaming responses are compressed
+chunk by chunk so each chunk reaches the client as soon as it is ready.
+
+MessagePack, CBOR and zstd need the optional msgpack, cbor2 and zstandard
+packages. When a package is not installed that format is not offered.
+"""
+
+import zlib
+from flask import current_app, jsonify, request
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # pragma: no cover
+    cbor2 = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+COMPRESS_MIN_SIZE = 500  # bytes, smaller responses are not worth compressing
+
+_serializers = {}
+if msgpack is not None:
+    _serializers['application/msgpack'] = msgpack.packb
+    _serializers['application/x-msgpack'] = msgpack.packb
+if cbor2 is not None:
+    _serializers['application/cbor'] = cbor2.dumps
+
+_encodings = ['gzip']
+if zstandard is not None:
+    _encodings.insert(0, 'zstd')
+
+
+def make_response(obj):
+    """
+    Serialize a response object in the format the client accepts.
+    """
+    mimetype = request.accept_mimetypes.best_match(['application/json'] + list(_serializers))
+    if mimetype in _serializers:
+        response = current_app.response_class(_serializers[mimetype](obj), mimetype=mimetype)
+    else:
+        response = jsonify(obj)
+    response.vary.add('Accept')
+    return response
+
+
+def _compressor(encoding):
+    """
+    Return a compressor object with the zlib compress and flush interface.
+    """
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor().compressobj()
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+
+
+def _compress_stream(chunks, encoding):
+    compressor = _compressor(encoding)
+    sync_flush = zstandard.COMPRESSOBJ_FLUSH_BLOCK if encoding == 'zstd' else zlib.Z_SYNC_FLUSH
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            # flush every chunk so a streaming client can decompress it right away
+            yield compressor.compress(chunk) + compressor.flush(sync_flush)
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response):
+    """
+    Compress a response with the best encoding the client accepts.
+    """
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(_encodings)
+    if encoding is None or response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        compressor = _compressor(encoding)
+        response.set_data(compressor.compress(data) + compressor.flush())
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,206 @@
+"""
+Cursor based pagination of v3 OSSI list results.
+
+A client asks for a page_size and gets an opaque cursor with each page that
+has more results after it. The cursor is sent back to get the next page.
+
+There are two ways to page through a list:
+
+range: when the client names a cursor_field the PBX does the paging with its
+       own syntax. Each page runs "<command> <start> count <page_size + 1>"
+       and the value of the cursor_field in the extra object is the start of
+       the next page.
+buffer: otherwise the whole list is read from the PBX once and the remainder
+        is kept in the worker for a few minutes to answer the next pages.
+"""
+
+import base64
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+BUFFER_TTL = 300  # seconds a buffered remainder is kept
+BUFFER_MAX = 100  # buffered remainders kept per worker
+
+_buffers = OrderedDict()
+_buffers_lock = threading.Lock()
+
+
+class CursorError(Exception):
+    """
+    The cursor can not be used to get the next page.
+    """
+
+
+def encode_cursor(state):
+    """
+    Encode the paging state as an opaque URL safe string.
+    """
+    data = json.dumps(state, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def _is_count(value, minimum):
+    """
+    Check for an integer, not a bool, that is at least minimum.
+    """
+    return isinstance(value, int) and not isinstance(value, bool) and value >= minimum
+
+
+def is_fields(fields):
+    """
+    Check for an OSSI fields dictionary of field IDs and string values.
+    """
+    return isinstance(fields, dict) and all(isinstance(k, str) and isinstance(v, str) for k, v in fields.items())
+
+
+def _check_state(state):
+    if not isinstance(state, dict) or not _is_count(state.get('page_size'), 1):
+        raise ValueError('bad cursor state')
+    if 'buffer' in state:
+        if not isinstance(state['buffer'], str) or not _is_count(state.get('offset'), 0):
+            raise ValueError('bad cursor offset')
+        return
+    for key in ('command', 'cursor_field', 'start'):
+        if not isinstance(state.get(key), str):
+            raise ValueError('bad cursor {}'.format(key))
+    if state.get('fields') is not None and not is_fields(state['fields']):
+        raise ValueError('bad cursor fields')
+    if not isinstance(state.get('columnar', False), bool):
+        raise ValueError('bad cursor format')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor made by encode_cursor.
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        state = json.loads(data.decode('utf-8'))
+        _check_state(state)
+    except (TypeError, ValueError) as e:  # binascii.Error is a ValueError
+        raise CursorError('Invalid cursor') from e
+    return state
+
+
+def range_command(command, start, count):
+    """
+    Add the PBX start and count qualifiers to a list command.
+    """
+    if start is None:
+        return '{} count {}'.format(command, count)
+    return '{} {} count {}'.format(command, start, count)
+
+
+def _records_key(response):
+    """
+    The key of the paged list: ossi_rows for columnar responses.
+    """
+    return 'ossi_rows' if 'ossi_rows' in response else 'ossi_objects'
+
+
+def _record_value(response, record, field):
+    if isinstance(record, dict):
+        return record.get(field)
+    if field in response['ossi_fields']:
+        return record[response['ossi_fields'].index(field)]
+    return None
+
+
+def range_page(pbx, command, fields, page_size, cursor_field, start=None, debug=False, columnar=False):
+    """
+    Get one page of a list command using the PBX range and count syntax.
+    """
+    if fields is not None and len(fields) > 0 and cursor_field not in fields:
+        fields = dict(fields, **{cursor_field: ''})
+
+    command_range = range_command(command, start, page_size + 1)
+    response = pbx.ossi_command(command_range, fields=fields, debug=debug, columnar=columnar)
+    key = _records_key(response)
+    records = response[key]
+    if len(records) > page_size and response.get('error') is None:
+        next_start = _record_value(response, records[page_size], cursor_field)
+        if next_start is None:
+            response['error'] = 'cursor_field {} is not in the results'.format(cursor_field)
+        else:
+            response['cursor'] = encode_cursor({
+                'command': command,
+                'fields': fields,
+                'page_size': page_size,
+                'cursor_field': cursor_field,
+                'start': next_start,
+                'columnar': columnar,
+            })
+        response[key] = records[:page_size]
+    return response
+
+
+def _expire_buffers(now):
+    for key in [key for key, buffered in _buffers.items() if buffered['expires'] < now]:
+        del _buffers[key]
+    while len(_buffers) > BUFFER_MAX:
+        _buffers.popitem(last=False)
+
+
+def _buffered_response(buffered, key, offset, page_size):
+    records = buffered['records']
+    response = {}
+    if buffered['ossi_fields'] is not None:
+        response['ossi_fields'] = buffered['ossi_fields']
+    response[buffered['key']] = records[offset:offset + page_size]
+    if offset + page_size < len(records):
+        response['cursor'] = encode_cursor({'buffer': key, 'offset': offset + page_size, 'page_size': page_size})
+    else:
+        with _buffers_lock:
+            _buffers.pop(key, None)
+    return response
+
+
+def buffered_page(response, page_size):
+    """
+    Return the first page of a complete response and buffer the remainder.
+
+    A response with an error, like a timeout part way through the list, is
+    paged too and the error is on the first page.
+    """
+    records_key = _records_key(response)
+    if len(response[records_key]) <= page_size:
+        return response
+
+    buffered = {
+        'expires': time.monotonic() + BUFFER_TTL,
+        'key': records_key,
+        'ossi_fields': response.get('ossi_fields'),
+        'records': response[records_key],
+    }
+    key = secrets.token_urlsafe(16)
+    with _buffers_lock:
+        _buffers[key] = buffered
+        _expire_buffers(time.monotonic())
+    page = _buffered_response(buffered, key, 0, page_size)
+    for extra in ('error', 'debug'):
+        if response.get(extra) is not None:
+            page[extra] = response[extra]
+    return page
+
+
+def next_page(pbx, cursor, debug=False):
+    """
+    Get the page that a cursor points to.
+    """
+    state = decode_cursor(cursor)
+    page_size = state['page_size']
+
+    if 'buffer' in state:
+        with _buffers_lock:
+            _expire_buffers(time.monotonic())
+            buffered = _buffers.get(state['buffer'])
+        if buffered is None:
+            raise CursorError('The cursor has expired or belongs to another worker')
+        return _buffered_response(buffered, state['buffer'], state['offset'], page_size)
+
+    command, fields, cursor_field, start = state['command'], state.get('fields'), state['cursor_field'], state['start']
+    columnar = state.get('columnar', False)
+    return range_page(pbx, command, fields, page_size, cursor_field, start=start, debug=debug, columnar=columnar)
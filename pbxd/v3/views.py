@@ -1,20 +1,137 @@
 from . import v3
+from . import encoding
+from . import pagination
 from flask import request, abort
+from flask import current_app as app
+import json
+import queue
 from ..app import logger
-from ..app import pbx
+from ..app import pbx, pool, monitors
+from ..pbx.monitor import MonitorBusy
+from ..pbx.pool import ConnectError
+
+MONITOR_KEEPALIVE = 15  # seconds between comments that keep an idle event stream open
+
+
+def _next_page(cursor, debug):
+    try:
+        return pagination.next_page(pool, cursor, debug=debug)
+    except pagination.CursorError as e:
+        logger.error(f'Error in v3, failed to get the next page: {str(e)}')
+        abort(400, description=str(e))
+
+
+@v3.errorhandler(ConnectError)
+def pbx_unavailable(e):
+    logger.error(f'Error in v3, unable to connect to PBX: {str(e)}')
+    return {"error": str(e)}, 503
+
+
+@v3.after_request
+def compress_response(response):
+    return encoding.compress_response(response)
 
 
 @v3.route('/', methods=['POST'])
 def pbx_command():
+    return encoding.make_response(_pbx_command())
+
+
+def _pbx_command():
     try:  # to parse the requested v3 command
         data = request.get_json(silent=True)
         logger.info(request.data)
-        termtype = data['termtype']
-        command = data['command']
-        fields = data.get('fields')
         debug = data.get('debug', False)
+        cursor = data.get('cursor')  # the cursor holds everything needed for the next page
+        if cursor is None:
+            termtype = data['termtype']
+            command = data['command']
+            fields = data.get('fields')
+            shards = data.get('shards')
+            if shards is not None and (not isinstance(shards, list) or len(shards) == 0
+                                       or not all(isinstance(shard, str) and shard.strip() != '' for shard in shards)):
+                raise ValueError('shards must be a list of command arguments')
+            page_size = data.get('page_size')
+            if page_size is not None and (not isinstance(page_size, int) or isinstance(page_size, bool) or page_size < 1):
+                raise ValueError('page_size must be a positive integer')
+            response_format = data.get('format', 'objects')
+            if response_format not in ('objects', 'columnar'):
+                raise ValueError('format must be objects or columnar')
+            columnar = response_format == 'columnar'
+            cursor_field = data.get('cursor_field')
+            if cursor_field is not None and (page_size is None or shards is not None):
+                raise ValueError('cursor_field requires page_size and can not be used with shards')
+            if cursor_field is not None and not isinstance(cursor_field, str):
+                raise ValueError('cursor_field must be a field ID')
+            if cursor_field is not None and fields is not None and not pagination.is_fields(fields):
+                raise ValueError('fields must map field IDs to values')
     except Exception as e:
         logger.error(f'Error in v3, failed to process request with exception: {str(e)}')
         abort(400, description='Bad request')
 
-    return pbx.send_pbx_command(termtype, command, fields=fields, debug=debug)
+    if cursor is not None:
+        return _next_page(cursor, debug)
+
+    if (shards is not None or page_size is not None) and termtype != pbx.Termtype.ossi.name:
+        return {"error": "Shards and pages are only supported with the ossi termtype."}
+
+    if cursor_field is not None:
+        return pagination.range_page(pool, command, fields, page_size, cursor_field, debug=debug, columnar=columnar)
+
+    if shards is not None:
+        response = pool.ossi_command_sharded(command, shards, fields=fields, debug=debug, columnar=columnar)
+    else:
+        response = pool.send_pbx_command(termtype, command, fields=fields, debug=debug, columnar=columnar)
+
+    if page_size is not None:
+        return pagination.buffered_page(response, page_size)
+    return response
+
+
+def _monitor_events(subscription, changes):
+    """
+    Format the monitor screens as server-sent events.
+    """
+    try:
+        while True:
+            try:
+                event = subscription.get(timeout=MONITOR_KEEPALIVE)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if event is None:  # the monitor command has ended
+                break
+            if event.get('error') is not None:
+                yield 'event: error\ndata: {}\n\n'.format(json.dumps({'error': event['error']}))
+            elif changes and event['changed'] is not None:
+                yield 'event: changes\ndata: {}\n\n'.format(json.dumps({'lines': event['changed']}))
+            else:
+                yield 'event: screen\ndata: {}\n\n'.format(json.dumps({'screen': '\n'.join(event['screen'])}))
+    finally:
+        monitors.unsubscribe(subscription)
+
+
+@v3.route('/monitor', methods=['GET'])
+def monitor_stream():
+    """
+    Stream the screens of a vt220 monitor or status command as server-sent
+    events. Every client watching the same command shares one PBX session.
+
+    command: the monitor or status command to run
+    changes: true to only send the changed lines after the first screen
+    """
+    command = ' '.join(request.args.get('command', '').split())
+    if command.split(' ')[0] not in ('monitor', 'status'):
+        abort(400, description='Bad request, command must be a monitor or status command')
+    changes = request.args.get('changes', 'false').lower() == 'true'
+
+    try:
+        subscription = monitors.subscribe(command)
+    except MonitorBusy as e:
+        logger.warning(f'Error in v3, unable to start monitor: {str(e)}')
+        abort(503, description=str(e))
+
+    resp = app.response_class(_monitor_events(subscription, changes), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
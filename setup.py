@@ -14,4 +14,12 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=['flask', 'gunicorn', 'pexpect', 'pyte', 'xmltodict'],
+    extras_require={
+        'cbor': ['cbor2'],
+        'msgpack': ['msgpack'],
+        'zstd': ['zstandard'],
+    },
+    entry_points={
+        'console_scripts': ['pbxd = pbxd.cli:main'],
+    },
 )
@@ -0,0 +1,129 @@
+import json
+import pbxd.cli
+
+# log in, then answer each OSSI command with one object holding the last word of the command
+pbx_script = r"""stty -echo
+printf 'Password: '
+read p
+printf 'Terminal Type (VT220): [513]'
+read t
+printf 't\n'
+while read c; do
+    while read t && [ "$t" != t ]; do :; done
+    if [ "$c" = "c logoff" ]; then printf 'Proceed With Logoff'; read y; exit; fi
+    printf 'f0001ff00\nd%s\nt\n' "${c##* }"
+done
+"""
+
+
+def write_config(tmp_path, login_limit=False):
+    script = tmp_path / 'pbx.sh'
+    script.write_text(pbx_script)
+    if login_limit:  # only the first login is accepted
+        login = tmp_path / 'login.sh'
+        login.write_text('mkdir {} 2>/dev/null || {{ echo Too many logins; exit 1; }}\nexec sh {}\n'.format(
+            tmp_path / 'logged_in', script))
+        script = login
+    config = tmp_path / 'pbxd_conf.json'
+    config.write_text(json.dumps({
+        'connection_command': 'sh {}'.format(script),
+        'pbx_username': 'test',
+        'pbx_password': 'none',
+    }))
+    return str(config)
+
+
+def test_jsonl_run_continues_from_checkpoint(tmp_path):
+    config = write_config(tmp_path)
+    commands = tmp_path / 'commands.jsonl'
+    output = tmp_path / 'results.jsonl'
+    checkpoint = tmp_path / 'results.checkpoint'
+    args = ['--config', config, '--sessions', '2', '--timeout', '5',
+            '--input', str(commands), '--output', str(output), '--checkpoint', str(checkpoint)]
+
+    commands.write_text(''.join(json.dumps({'command': 'list station {}'.format(i)}) + '\n' for i in range(1, 6)))
+    assert pbxd.cli.main(args) == 0
+    assert checkpoint.read_text() == '5 {}\n'.format(output.stat().st_size)
+
+    with commands.open('a') as f:
+        f.write(json.dumps({'termtype': 'ossi', 'command': 'list station 6', 'fields': {'0001ff00': ''}}) + '\n')
+    assert pbxd.cli.main(args) == 0
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [r['line'] for r in results] == [1, 2, 3, 4, 5, 6]
+    assert [r['ossi_objects'] for r in results] == [[{'0001ff00': '{}'.format(i)}] for i in range(1, 7)]
+
+
+def test_continue_removes_output_after_checkpoint(tmp_path):
+    config = write_config(tmp_path)
+    commands = tmp_path / 'commands.jsonl'
+    output = tmp_path / 'results.jsonl'
+    checkpoint = tmp_path / 'results.checkpoint'
+    commands.write_text(''.join(json.dumps({'command': 'list station {}'.format(i)}) + '\n' for i in range(1, 4)))
+    first_line = json.dumps({'line': 1, 'termtype': 'ossi', 'command': 'list station 1'}) + '\n'
+    # a run that stopped after writing line 2 but before its checkpoint
+    output.write_text(first_line + 'line 2 written before the checkpoint\n')
+    checkpoint.write_text('1 {}\n'.format(len(first_line)))
+    args = ['--config', config, '--input', str(commands), '--output', str(output), '--checkpoint', str(checkpoint)]
+    assert pbxd.cli.main(args) == 0
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [r['line'] for r in results] == [1, 2, 3]
+
+
+def test_run_continues_at_the_login_limit(tmp_path):
+    config = write_config(tmp_path, login_limit=True)
+    commands = tmp_path / 'commands.jsonl'
+    output = tmp_path / 'results.jsonl'
+    commands.write_text(''.join(json.dumps({'command': 'list station {}'.format(i)}) + '\n' for i in range(1, 9)))
+    args = ['--config', config, '--sessions', '3', '--timeout', '5', '--input', str(commands), '--output', str(output)]
+    assert pbxd.cli.main(args) == 0
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [r['ossi_objects'] for r in results] == [[{'0001ff00': '{}'.format(i)}] for i in range(1, 9)]
+    # the run stops when no session can log in
+    assert pbxd.cli.main(args) == 1
+
+
+def test_bad_checkpoint_stops_the_run(tmp_path, caplog):
+    config = write_config(tmp_path)
+    commands = tmp_path / 'commands.jsonl'
+    output = tmp_path / 'results.jsonl'
+    checkpoint = tmp_path / 'results.checkpoint'
+    commands.write_text('{"command": "list station 1"}\n')
+    args = ['--config', config, '--input', str(commands), '--output', str(output), '--checkpoint', str(checkpoint)]
+
+    checkpoint.write_text('not a line number\n')
+    assert pbxd.cli.main(args) == 1
+    assert 'Stopped: Invalid checkpoint file' in caplog.text
+
+    # the output of the checkpoint has been removed
+    checkpoint.write_text('1 100\n')
+    assert pbxd.cli.main(args) == 1
+    assert 'is missing' in caplog.text
+    assert not output.exists()
+
+
+def test_csv_run(tmp_path):
+    config = write_config(tmp_path)
+    commands = tmp_path / 'commands.csv'
+    output = tmp_path / 'results.csv'
+    commands.write_text('command,0001ff00\ndisplay station 12345,\ndisplay station 12346,\n')
+    assert pbxd.cli.main(['--config', config, '--input', str(commands), '--output', str(output)]) == 0
+    assert output.read_text().splitlines() == [
+        'line,termtype,command,object,field,value,error',
+        '1,ossi,display station 12345,1,0001ff00,12345,',
+        '2,ossi,display station 12346,1,0001ff00,12346,',
+    ]
+
+    # without a checkpoint the output is written again instead of appended
+    assert pbxd.cli.main(['--config', config, '--input', str(commands), '--output', str(output)]) == 0
+    assert len(output.read_text().splitlines()) == 3
+
+
+def test_bad_input_stops_the_run(tmp_path):
+    config = write_config(tmp_path)
+    commands = tmp_path / 'commands.jsonl'
+    commands.write_text('{"command": "list station 1"}\nnot json\n')
+    checkpoint = tmp_path / 'results.checkpoint'
+    args = ['--config', config, '--input', str(commands), '--output', str(tmp_path / 'results.jsonl'),
+            '--checkpoint', str(checkpoint)]
+    assert pbxd.cli.main(args) == 1
+    assert checkpoint.read_text().split()[0] == '1'
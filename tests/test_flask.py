@@ -1,13 +1,28 @@
 from flask import json
+import gzip
 import os
 import pexpect
+import pytest
+import queue
 
 pbx_name = 'n1'
 os.environ['APPLICATION_ROOT'] = '/{}'.format(pbx_name)
 os.environ['PBXD_CONF'] = 'tests/pbxd_test_conf.json'
 os.environ['PBX_COMMAND_TIMEOUT'] = '5'
+from collections import OrderedDict  # noqa: E402
+import xmltodict  # noqa: E402
+import time  # noqa: E402
 import pbxd.app  # noqa: E402
+import pbxd.main.views  # noqa: E402
+import pbxd.pbx.pool  # noqa: E402
 from pbxd.app import pbx  # noqa: E402
+from pbxd.pbx import definity  # noqa: E402
+from pbxd.pbx.pool import TerminalPool  # noqa: E402
+from pbxd.pbx.monitor import SUBSCRIBER_QUEUE_SIZE, Monitor, MonitorBusy, MonitorRegistry, Subscription  # noqa: E402
+from pbxd.pbx.trace import Transcript  # noqa: E402
+from pbxd.v2 import views as v2_views  # noqa: E402
+from pbxd.v3 import encoding, pagination  # noqa: E402
+from pbxd.v3 import views as v3_views  # noqa: E402
 
 
 app = pbxd.app.load()
@@ -20,6 +35,59 @@ def test_health_check():
         assert b'ossi_objects' in rv.data
 
 
+def test_ready():
+    with app.test_client() as c:
+        rv = c.get('/{}/ready'.format(pbx_name))
+        assert rv.status_code == 200
+
+
+def test_background_connect_retries(monkeypatch):
+    monkeypatch.setattr(pbxd.pbx.pool, 'CONNECT_BACKOFF_INITIAL', 0.1)
+    terminal = definity.Terminal('sh -c "echo Too many logins"', 'test', 'none', pbx_command_timeout=2)
+    pool = TerminalPool([terminal])
+    pool.connect_in_background(1)
+    time.sleep(0.5)
+    assert not pool.ready()
+    assert terminal.session is None
+    terminal.connection_command = pbxd.app.config['connection_command']
+    for _ in range(50):
+        if pool.ready():
+            break
+        time.sleep(0.1)
+    assert pool.ready()
+    with pool.terminal(timeout=1) as t:
+        assert t.connected_termtype == t.Termtype.ossi
+    terminal.session.close()
+
+
+def test_requests_during_pbx_outage(monkeypatch, tmp_path):
+    monkeypatch.setattr(pbxd.pbx.pool, 'CONNECT_BACKOFF_INITIAL', 30)
+    logins = tmp_path / 'logins'
+    terminal = definity.Terminal('sh -c "echo login >> {}; echo Too many logins"'.format(logins), 'test', 'none')
+    pool = TerminalPool([terminal])
+    for views in (pbxd.main.views, v2_views, v3_views):
+        monkeypatch.setattr(views, 'pool', pool)
+    pool.connect_in_background(1)
+    for _ in range(50):
+        if len(pool._retrying) > 0:
+            break
+        time.sleep(0.1)
+    app.testing = True
+    with app.test_client() as c:
+        rv = c.get('/{}/healthz'.format(pbx_name))
+        assert rv.status_code == 503
+        assert 'Unable to connect to PBX' in rv.get_json()['error']
+        rv = c.post('/{}/v3/'.format(pbx_name), json={"termtype": "ossi", "command": "display time"})
+        assert rv.status_code == 503
+        assert 'Unable to connect to PBX' in rv.get_json()['error']
+        v2_post = '<command pbxName="{}" cmdType="ossi" cmd="display time"/>'.format(pbx_name)
+        rv = c.post('/{}/v2/'.format(pbx_name), data={"request": v2_post})
+        assert rv.status_code == 503
+        assert b'<error>ERROR: Unable to connect to PBX' in rv.data
+    # the requests wait for the background login instead of logging in themselves
+    assert logins.read_text() == 'login\n'
+
+
 def test_bad_v3_request():
     app.testing = True
     with app.test_client() as c:
@@ -187,6 +255,359 @@ def test_vt220_paging():
     assert_in_v2_response('vt220', expected_texts, v2_post, expect_stream)
 
 
+# answer each OSSI list command with one object holding the last word of the command
+ossi_echo_script = r"""stty -echo && while read c; do
+    while read t && [ "$t" != t ]; do :; done
+    printf 'f0001ff00\nd%s\nt\n' "${c##* }"
+done"""
+
+
+def ossi_echo_terminal():
+    terminal = definity.Terminal('none', 'test', 'none', pbx_command_timeout=2)
+    terminal.session = pexpect.spawn('sh', ['-c', ossi_echo_script], timeout=2)
+    terminal.connected_termtype = terminal.Termtype.ossi
+    return terminal
+
+
+def test_ossi_sharded_list_keeps_shard_order():
+    terminals = [ossi_echo_terminal() for i in range(3)]
+    pool = TerminalPool(terminals)
+    shards = ['{}'.format(i) for i in range(1, 10)]
+    result = pool.ossi_command_sharded('list station', shards, fields={'0001ff00': ''})
+    assert result == {'ossi_objects': [{'0001ff00': s} for s in shards]}
+    for terminal in terminals:
+        terminal.session.close()
+
+
+def test_ossi_sharded_list_with_failed_login():
+    good = ossi_echo_terminal()
+    bad = definity.Terminal('sh -c "echo Too many logins"', 'test', 'none', pbx_command_timeout=2)
+    pool = TerminalPool([good, bad])
+    shards = ['{}'.format(i) for i in range(1, 5)]
+    result = pool.ossi_command_sharded('list station', shards, fields={'0001ff00': ''})
+    assert result == {'ossi_objects': [{'0001ff00': s} for s in shards]}
+    assert bad.session is None
+    good.session.close()
+
+    result = TerminalPool([bad]).ossi_command_sharded('list station', shards, fields={'0001ff00': ''})
+    assert result['ossi_objects'] == []
+    assert 'Unable to connect to PBX' in result['error']
+
+
+def test_v3_sharded_list():
+    pbx.connected_termtype = pbx.Termtype.ossi
+    pbx.session = pexpect.spawn('sh', ['-c', ossi_echo_script], timeout=2)
+    app.testing = True
+    with app.test_client() as c:
+        v3_post = {"termtype": "ossi", "command": "list station", "shards": ["10", "20"]}
+        resp = c.post('/{}/v3/'.format(pbx_name), json=v3_post)
+        assert json.loads(resp.data) == {'ossi_objects': [{'0001ff00': '10'}, {'0001ff00': '20'}]}
+        resp = c.post('/{}/v3/'.format(pbx_name), json={"termtype": "vt220", "command": "list station", "shards": ["10"]})
+        assert 'error' in json.loads(resp.data)
+        resp = c.post('/{}/v3/'.format(pbx_name), json={"termtype": "ossi", "command": "list station", "shards": "10"})
+        assert resp.status_code == 400
+        for shards in ([None, {}], ["10", ""], ["10", 20]):
+            resp = c.post('/{}/v3/'.format(pbx_name), json={"termtype": "ossi", "command": "list station", "shards": shards})
+            assert resp.status_code == 400
+    pbx.session.close()
+
+
+# answer "list station [start] count n" from a list of the extensions 1 to 5
+ossi_range_script = r"""stty -echo && while read c; do
+    while read t && [ "$t" != t ]; do :; done
+    set -- $c
+    case $c in *count*) eval n=\${$#};; *) n=5;; esac
+    if [ $# -eq 6 ]; then i=$4; else i=1; fi
+    printf 'f0001ff00\n'
+    while [ $i -le 5 ] && [ $n -gt 0 ]; do printf 'd%s\nn\n' $i; i=$((i + 1)); n=$((n - 1)); done
+    printf 't\n'
+done"""
+
+
+def test_v3_pages_from_buffer():
+    pbx.connected_termtype = pbx.Termtype.ossi
+    pbx.session = pexpect.spawn('sh', ['-c', ossi_range_script], timeout=2)
+    app.testing = True
+    with app.test_client() as c:
+        v3_post = {"termtype": "ossi", "command": "list station", "page_size": 2}
+        data = json.loads(c.post('/{}/v3/'.format(pbx_name), json=v3_post).data)
+        assert data['ossi_objects'] == [{'0001ff00': '1'}, {'0001ff00': '2'}]
+        data = json.loads(c.post('/{}/v3/'.format(pbx_name), json={"cursor": data['cursor']}).data)
+        assert data['ossi_objects'] == [{'0001ff00': '3'}, {'0001ff00': '4'}]
+        last_cursor = data['cursor']
+        buffer = pagination.decode_cursor(last_cursor)['buffer']
+        for state in ({"buffer": buffer, "page_size": 1}, {"buffer": buffer, "offset": -1, "page_size": 1},
+                      {"buffer": buffer, "offset": "4", "page_size": 1}, {"buffer": buffer, "offset": 4, "page_size": True}):
+            cursor = pagination.encode_cursor(state)
+            assert c.post('/{}/v3/'.format(pbx_name), json={"cursor": cursor}).status_code == 400
+        data = json.loads(c.post('/{}/v3/'.format(pbx_name), json={"cursor": last_cursor}).data)
+        assert data == {'ossi_objects': [{'0001ff00': '5'}]}
+        # the buffer is released after the last page
+        assert c.post('/{}/v3/'.format(pbx_name), json={"cursor": last_cursor}).status_code == 400
+        assert c.post('/{}/v3/'.format(pbx_name), json={"cursor": "not a cursor"}).status_code == 400
+        v3_post = {"termtype": "ossi", "command": "list station", "page_size": True}
+        assert c.post('/{}/v3/'.format(pbx_name), json=v3_post).status_code == 400
+    pbx.session.close()
+
+
+def test_buffered_pages_keep_the_error():
+    response = {'ossi_objects': [{'0001ff00': '{}'.format(i)} for i in range(1, 6)], 'error': 'PBX timeout'}
+    page = pagination.buffered_page(response, 2)
+    assert page['ossi_objects'] == [{'0001ff00': '1'}, {'0001ff00': '2'}]
+    assert page['error'] == 'PBX timeout'
+    page = pagination.next_page(None, page['cursor'])
+    assert page['ossi_objects'] == [{'0001ff00': '3'}, {'0001ff00': '4'}]
+    assert 'error' not in page
+
+
+def test_v3_pages_from_pbx_range():
+    pbx.connected_termtype = pbx.Termtype.ossi
+    pbx.session = pexpect.spawn('sh', ['-c', ossi_range_script], timeout=2)
+    app.testing = True
+    with app.test_client() as c:
+        v3_post = {"termtype": "ossi", "command": "list station", "page_size": 2, "cursor_field": "0001ff00"}
+        ossi_objects = []
+        data = json.loads(c.post('/{}/v3/'.format(pbx_name), json=v3_post).data)
+        while 'cursor' in data:
+            assert len(data['ossi_objects']) == 2
+            ossi_objects += data['ossi_objects']
+            data = json.loads(c.post('/{}/v3/'.format(pbx_name), json={"cursor": data['cursor']}).data)
+        ossi_objects += data['ossi_objects']
+        assert ossi_objects == [{'0001ff00': '{}'.format(i)} for i in range(1, 6)]
+        range_state = {"page_size": 1, "command": "list station", "fields": None, "cursor_field": "f", "start": "1"}
+        for state in (dict(range_state, fields="abc"), dict(range_state, fields={"f": 1}), dict(range_state, start=1),
+                      dict(range_state, cursor_field=None), dict(range_state, command=["list"])):
+            cursor = pagination.encode_cursor(state)
+            assert c.post('/{}/v3/'.format(pbx_name), json={"cursor": cursor}).status_code == 400
+        for bad_post in (dict(v3_post, cursor_field=5, fields={"0001ff00": ""}), dict(v3_post, fields="abc")):
+            assert c.post('/{}/v3/'.format(pbx_name), json=bad_post).status_code == 400
+    pbx.session.close()
+
+
+def test_v3_columnar_format():
+    v3_post = {"termtype": "ossi", "command": "list extension count 3", "format": "columnar"}
+    # the PBX has returned duplicate field ids for some commands
+    expect_stream = "sh -c \"stty -echo && printf 'f0001ff00\t0002ff00\t0001ff00\nd12345\ta\tb\nn\nd21000\tc\td\nt\n' && cat -\""
+    pbx.connected_termtype = pbx.Termtype.ossi
+    pbx.session = pexpect.spawn(expect_stream, timeout=2)
+    app.testing = True
+    with app.test_client() as c:
+        data = json.loads(c.post('/{}/v3/'.format(pbx_name), json=v3_post).data)
+        assert data == {
+            'ossi_fields': ['0001ff00', '0002ff00', '0001ff00'],
+            'ossi_rows': [['12345', 'a', 'b'], ['21000', 'c', 'd']],
+        }
+        assert c.post('/{}/v3/'.format(pbx_name), json=dict(v3_post, format='xml')).status_code == 400
+    pbx.session.close()
+
+
+def test_v3_columnar_pages_from_pbx_range():
+    pbx.connected_termtype = pbx.Termtype.ossi
+    pbx.session = pexpect.spawn('sh', ['-c', ossi_range_script], timeout=2)
+    app.testing = True
+    with app.test_client() as c:
+        v3_post = {"termtype": "ossi", "command": "list station", "page_size": 3, "cursor_field": "0001ff00",
+                   "format": "columnar"}
+        data = json.loads(c.post('/{}/v3/'.format(pbx_name), json=v3_post).data)
+        assert data['ossi_rows'] == [['1'], ['2'], ['3']]
+        data = json.loads(c.post('/{}/v3/'.format(pbx_name), json={"cursor": data['cursor']}).data)
+        assert data == {'ossi_fields': ['0001ff00'], 'ossi_rows': [['4'], ['5']]}
+    pbx.session.close()
+
+
+def test_v3_gzip_response():
+    v3_post = {"termtype": "ossi", "command": "list station"}
+    ossi_lines = 'f0001ff00\\n' + ''.join(['d{}\\nn\\n'.format(i) for i in range(40)]) + 't\\n'
+    pbx.connected_termtype = pbx.Termtype.ossi
+    app.testing = True
+    with app.test_client() as c:
+        pbx.session = pexpect.spawn('sh', ['-c', "stty -echo && printf '{}' && cat -".format(ossi_lines)], timeout=2)
+        resp = c.post('/{}/v3/'.format(pbx_name), json=v3_post, headers={'Accept-Encoding': 'gzip'})
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert len(json.loads(gzip.decompress(resp.data))['ossi_objects']) == 40
+        pbx.session.close()
+        pbx.session = pexpect.spawn('sh', ['-c', "stty -echo && printf '{}' && cat -".format(ossi_lines)], timeout=2)
+        resp = c.post('/{}/v3/'.format(pbx_name), json=v3_post)
+        assert 'Content-Encoding' not in resp.headers
+        assert len(json.loads(resp.data)['ossi_objects']) == 40
+        pbx.session.close()
+
+
+def test_v3_msgpack_response():
+    msgpack = pytest.importorskip('msgpack')
+    v3_post = {"termtype": "ossi", "command": "display time", "fields": {"0007ff00": ""}}
+    expect_stream = "sh -c \"stty -echo && printf 'f0007ff00\nd56\nt\n' && cat -\""
+    pbx.connected_termtype = pbx.Termtype.ossi
+    pbx.session = pexpect.spawn(expect_stream, timeout=2)
+    app.testing = True
+    with app.test_client() as c:
+        resp = c.post('/{}/v3/'.format(pbx_name), json=v3_post, headers={'Accept': 'application/msgpack'})
+        assert resp.mimetype == 'application/msgpack'
+        assert msgpack.unpackb(resp.data) == {'ossi_objects': [{'0007ff00': '56'}]}
+    pbx.session.close()
+
+
+def test_compressed_stream_chunks():
+    chunks = [b'data: first\n\n', 'data: second\n\n']
+    compressed = list(encoding._compress_stream(iter(chunks), 'gzip'))
+    assert gzip.decompress(b''.join(compressed)) == b'data: first\n\ndata: second\n\n'
+
+
+def unparse_v2_tree(pbx_name, termtype, command, v3_response):
+    """
+    The v2 xml as it was written with xmltodict before the streaming writer.
+    """
+    obj = {'command': {'@cmd': command, '@cmdType': termtype, '@pbxName': pbx_name}}
+    if v3_response.get('error') is not None:
+        obj['command']['error'] = 'ERROR: {}'.format(v3_response['error'])
+    elif v3_response.get('screens') is not None:
+        obj['command']['screen'] = [OrderedDict([('@page', i + 1), ('#text', s)]) for i, s in enumerate(v3_response['screens'])]
+    elif v3_response.get('ossi_rows') is not None:
+        ossi_objects = []
+        for i, row in enumerate(v3_response['ossi_rows']):
+            o = dict(zip(v3_response['ossi_fields'], row))
+            ossi_objects.append(OrderedDict([('@i', i + 1), ('field', [OrderedDict([('@fid', f), ('#text', o[f])]) for f in o])]))
+        obj['command']['ossi_object'] = ossi_objects if len(ossi_objects) > 0 else {}
+    return xmltodict.unparse(obj, pretty=True, indent='  ')
+
+
+@pytest.mark.parametrize('termtype,v3_response', [
+    ('ossi', {'ossi_fields': ['0001ff00', '0002ff00'], 'ossi_rows': [['1 & <2>', ''], ['"x"', "y'"]]}),
+    ('ossi', {'ossi_fields': ['0001ff00', '0002ff00', '0001ff00'], 'ossi_rows': [['a', 'b', 'c']]}),
+    ('ossi', {'ossi_fields': ['0001ff00'], 'ossi_rows': []}),
+    ('ossi', {'ossi_fields': [], 'ossi_rows': [], 'error': '1 a & b'}),
+    ('vt220', {'screens': ['line 1\n  <line 2>  ', '']}),
+])
+def test_v2_xml_writer_matches_xmltodict(termtype, v3_response):
+    command = 'list "station" & <more>'
+    xml = ''.join(v2_views._chunks(v2_views._v2_xml("n'1", termtype, command, v3_response), size=10))
+    assert xml == unparse_v2_tree("n'1", termtype, command, v3_response)
+
+
+# draw a monitor screen, redraw line 3 and wait for the VT220 cancel key
+monitor_script = r"""stty -echo -icanon && read c && printf 'Traffic %s\033[23;80H' "$c" && sleep 0.5 &&
+printf '\033[3;1Hline 3\033[23;80H' && head -c 4 >/dev/null && printf '\033[24;1H\033[KCommand: ' && cat -"""
+
+
+def test_shared_monitor_subscribers():
+    terminal = definity.Terminal('none', 'test', 'none', pbx_command_timeout=5)
+    terminal.session = pexpect.spawn('sh', ['-c', monitor_script], timeout=2)
+    terminal.connected_termtype = terminal.Termtype.vt220
+    pool = TerminalPool([terminal])
+    monitors = MonitorRegistry(pool, max_monitors=1)
+
+    subscriptions = [monitors.subscribe('monitor traffic'), monitors.subscribe('monitor traffic')]
+    with pytest.raises(MonitorBusy):
+        monitors.subscribe('monitor bcms system')
+    for subscription in subscriptions:
+        event = subscription.get(timeout=5)
+        assert event['screen'][0].startswith('Traffic monitor traffic')
+        event = subscription.get(timeout=5)
+        assert event['changed'] == {2: 'line 3'.ljust(80)}
+
+    monitor = subscriptions[0].monitor
+    for subscription in subscriptions:
+        monitors.unsubscribe(subscription)
+    monitor._thread.join(timeout=5)
+    assert monitors.monitors == {}
+    with pool.terminal(timeout=1) as t:
+        assert t is terminal
+    terminal.session.close()
+
+
+def test_failed_monitor_logs_in_again(monkeypatch):
+    def publish_fails(monitor, lines):
+        raise queue.Empty()
+
+    monkeypatch.setattr(Monitor, '_publish_screen', publish_fails)
+    terminal = definity.Terminal(pbxd.app.config['connection_command'], 'test', 'none', pbx_command_timeout=5)
+    terminal.session = pexpect.spawn('sh', ['-c', monitor_script], timeout=1)
+    terminal.connected_termtype = terminal.Termtype.vt220
+    monitor_session = terminal.session
+    monitors = MonitorRegistry(TerminalPool([terminal]), max_monitors=1)
+    subscription = monitors.subscribe('monitor traffic')
+    assert 'error' in subscription.get(timeout=10)
+    assert subscription.get(timeout=5) is None
+    # the session still running the monitor is not handed to the next command
+    assert not monitor_session.isalive()
+    assert terminal.session is not monitor_session
+    assert terminal.connected_termtype == terminal.Termtype.ossi
+    terminal.session.close()
+
+
+def test_subscription_skips_to_the_current_screen():
+    subscription = Subscription(None)
+    for i in range(SUBSCRIBER_QUEUE_SIZE + 1):
+        subscription.put({'screen': [str(i)], 'changed': {0: str(i)}})
+    assert subscription.get(timeout=1) == {'screen': [str(SUBSCRIBER_QUEUE_SIZE)], 'changed': None}
+    with pytest.raises(queue.Empty):
+        subscription.get(timeout=0)
+
+
+def test_v3_monitor_stream(monkeypatch):
+    primary = definity.Terminal('none', 'test', 'none', pbx_command_timeout=5)
+    terminal = definity.Terminal('none', 'test', 'none', pbx_command_timeout=5)
+    terminal.session = pexpect.spawn('sh', ['-c', monitor_script], timeout=2)
+    terminal.connected_termtype = terminal.Termtype.vt220
+    monitors = MonitorRegistry(TerminalPool([primary, terminal]), max_monitors=1)
+    monkeypatch.setattr(v3_views, 'monitors', monitors)
+    app.testing = True
+    with app.test_client() as c:
+        resp = c.get('/{}/v3/monitor?command=monitor traffic&changes=true'.format(pbx_name), buffered=False)
+        assert resp.status_code == 200
+        assert resp.mimetype == 'text/event-stream'
+        events = iter(resp.response)
+        event = next(events).decode()
+        assert event.startswith('event: screen\n')
+        assert json.loads(event.split('data: ')[1])['screen'].startswith('Traffic monitor traffic')
+        event = next(events).decode()
+        assert event.startswith('event: changes\n')
+        assert json.loads(event.split('data: ')[1]) == {'lines': {'2': 'line 3'.ljust(80)}}
+        monitor = monitors.monitors['monitor traffic']
+        resp.close()
+    assert monitors.monitors == {}
+    monitor._thread.join(timeout=5)
+    assert not monitor._thread.is_alive()
+    terminal.session.close()
+
+
+def test_v3_monitor_request_errors():
+    app.testing = True
+    with app.test_client() as c:
+        assert c.get('/{}/v3/monitor?command=change station 1'.format(pbx_name)).status_code == 400
+        # a worker with one PBX_SESSIONS keeps it for other commands
+        assert c.get('/{}/v3/monitor?command=monitor traffic'.format(pbx_name)).status_code == 503
+
+
+def test_transcript_is_bounded():
+    transcript = Transcript(max_bytes=10, max_spans=2)
+    for data in [b'f0001ff00\n', b'd12345\n', b't\n']:
+        transcript.reader.write(data)
+    transcript.sender.write(b'c list\n')
+    for command in ['one', 'two', 'three']:
+        transcript.span(command, 'ossi', time.monotonic())
+    dump = transcript.dump()
+    assert [(c['direction'], c['data']) for c in dump['transcript']] == [('read', 't\n'), ('send', 'c list\n')]
+    assert [s['command'] for s in dump['spans']] == ['two', 'three']
+
+
+def test_trace_dump():
+    v3_post = {"termtype": "ossi", "command": "display time", "fields": {"0007ff00": ""}}
+    expect_stream = "sh -c \"stty -echo && printf 'f0007ff00\nd56\nt\n' && cat -\""
+    pbx.connected_termtype = pbx.Termtype.ossi
+    pbx.session = pexpect.spawn(expect_stream, timeout=2)
+    pbx.session.logfile_read = pbx.transcript.reader
+    app.testing = True
+    with app.test_client() as c:
+        c.post('/{}/v3/'.format(pbx_name), json=v3_post)
+        data = json.loads(c.get('/{}/trace'.format(pbx_name)).data)
+        span = data['sessions'][0]['spans'][-1]
+        assert span['command'] == 'display time'
+        assert span['objects'] == 1
+        assert 'd56' in ''.join(chunk['data'] for chunk in data['sessions'][0]['transcript'])
+    pbx.session.close()
+
+
 def test_setup_session_for_disconnect():
     # this sets the session so the flask atexit can exit cleanly
     pbx.session = pexpect.spawn("sh -c \"printf 'Proceed With Logoff' && sleep 1\"", timeout=5)